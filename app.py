@@ -1,27 +1,42 @@
 # app.py
 import os
-import io
 import re
 import json
+import multiprocessing
+import sqlite3
+import hashlib
 import heapq
 import string
+import sys
+import tempfile
 import threading
-from typing import Dict, Generator, List, Tuple
+import time
+from functools import partial
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, FrozenSet, Generator, List, Optional, Set, Tuple
 
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 
+import numpy as np
 import fitz  # PyMuPDF
-import gspread
+import httplib2
 from oauth2client.service_account import ServiceAccountCredentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
 
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
 import google.generativeai as genai
 
+from pdf_text import extract_pages
+
 
 # -----------------------------
 # Flask
@@ -43,9 +58,48 @@ if not SERVICE_ACCOUNT_JSON:
     raise ValueError("SERVICE_ACCOUNT_JSON not set.")
 creds = ServiceAccountCredentials.from_json_keyfile_dict(json.loads(SERVICE_ACCOUNT_JSON), SCOPES)
 
-drive = build("drive", "v3", credentials=creds)
-docs = build("docs", "v1", credentials=creds)
-gspread_client = gspread.authorize(creds)
+drive = build("drive", "v3", credentials=creds, cache_discovery=False)
+docs = build("docs", "v1", credentials=creds, cache_discovery=False)
+sheets = build("sheets", "v4", credentials=creds, cache_discovery=False)
+
+# httplib2.Http is not thread-safe: every thread that talks to Google gets its own
+# authorized connection, and API calls are capped process-wide to stay clear of 429s.
+# The socket timeout keeps a stalled download from pinning a fetch thread (and its slot).
+_local = threading.local()
+_api_slots = threading.Semaphore(10)
+GOOGLE_HTTP_TIMEOUT = int(os.environ.get("GOOGLE_HTTP_TIMEOUT", "60"))  # seconds per socket read
+
+def thread_http() -> httplib2.Http:
+    http = getattr(_local, "http", None)
+    if http is None:
+        http = _local.http = creds.authorize(httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT))
+    return http
+
+BATCH_SIZE = 25  # Google no longer reliably accepts 100 calls per batch
+
+def batch_fetch(service, files: List[Dict], make_request: Callable[[Dict], object], tag: str) -> Dict[str, Dict]:
+    """
+    Issue one API call per file through batch requests, BATCH_SIZE calls per HTTP round trip.
+    Returns file_id -> response; files whose call failed are logged and left out.
+    """
+    out: Dict[str, Dict] = {}
+
+    def on_response(fid: str, res: Dict, exc: Optional[Exception]):
+        if exc is not None:
+            print(f"[{tag}] ({fid}) read error: {exc}")
+            return
+        out[fid] = res
+
+    for start in range(0, len(files), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_response)
+        for f in files[start:start + BATCH_SIZE]:
+            batch.add(make_request(f), request_id=f["id"])
+        try:
+            batch.execute(http=thread_http())
+        except Exception as e:
+            # these files stay uncached and are retried on the next question
+            print(f"[{tag}] batch of {len(files[start:start + BATCH_SIZE])} failed: {e}")
+    return out
 
 SLACK_BOT_TOKEN = os.environ.get("SLACK_BOT_TOKEN")
 if not SLACK_BOT_TOKEN:
@@ -70,21 +124,23 @@ gemini = genai.GenerativeModel(
 # -----------------------------
 # Helpers
 # -----------------------------
-STOPWORDS = set("""
+STOPWORDS = frozenset("""
 a an and are as at be by for from has have if in into is it its of on or that the their to was were will with you your
 """.split())
+_PUNCT_TABLE = str.maketrans({c: " " for c in string.punctuation})
+_MENTION_RE = re.compile(r"<@[^>]+>")
 
 def norm(t: str) -> str:
-    t = t.replace("\u00a0", " ")
-    t = re.sub(r"\s+", " ", t).strip()
-    return t
+    # str.split() treats every Unicode space (incl. \u00a0) as a separator and drops
+    # leading/trailing runs, so this collapses whitespace in one C-level pass
+    return " ".join(t.split())
 
 def toks(s: str) -> List[str]:
-    s = s.lower().translate(str.maketrans({c: " " for c in string.punctuation}))
+    s = s.lower().translate(_PUNCT_TABLE)
     return [w for w in s.split() if w and w not in STOPWORDS]
 
-def overlap(query_tokens: List[str], text: str) -> int:
-    return len(set(query_tokens) & set(toks(text)))
+def overlap(query_tokens: FrozenSet[str], tokens: FrozenSet[str]) -> int:
+    return len(query_tokens & tokens)
 
 
 # -----------------------------
@@ -110,47 +166,100 @@ def list_in_shared_drive(drive_id: str) -> List[Dict]:
             includeItemsFromAllDrives=True,
             supportsAllDrives=True,
             q=q,
-            fields="files(id,name,mimeType),nextPageToken",
+            fields="files(id,name,mimeType,modifiedTime,md5Checksum,parents),nextPageToken",
             pageToken=page,
             pageSize=200,
-        ).execute()
+        ).execute(http=thread_http())
         files.extend(res.get("files", []))
         page = res.get("nextPageToken")
         if not page:
             break
     return files
 
+
 def list_in_folder_recursive(folder_id: str) -> List[Dict]:
-    queue = [folder_id]
+    """
+    Breadth-first folder walk. Pending folder listings (and their follow-up pages) are
+    sent as Drive batch requests, up to BATCH_SIZE listings per HTTP round trip.
+    A listing that still fails after one retry fails the whole walk: a partial listing
+    would make sync_file_listing drop every cached file under the missing folders.
+    """
+    queue = deque([(folder_id, None)])
     files: List[Dict] = []
-    seen = set()
+    seen = {folder_id}
+    retried: Set[Tuple[str, Optional[str]]] = set()
+    failed: List[str] = []
+    level: List[Tuple[str, Optional[str]]] = []
+
+    def retry(item: Tuple[str, Optional[str]], exc: Exception):
+        if item in retried:
+            failed.append(f"{item[0]}: {exc}")
+            return
+        print(f"[List] Folder {item[0]} listing failed, retrying: {exc}")
+        retried.add(item)
+        queue.append(item)
+
+    def on_list(request_id: str, res: Dict, exc: Optional[Exception]):
+        item = level[int(request_id)]
+        if exc is not None:
+            retry(item, exc)
+            return
+        fid = item[0]
+        for f in res.get("files", []):
+            mt = f["mimeType"]
+            if mt == MIME_FOLDER:
+                if f["id"] not in seen:
+                    seen.add(f["id"])
+                    queue.append((f["id"], None))
+            elif mt in (MIME_DOC, MIME_SHEET, MIME_PDF):
+                files.append(f)
+        page = res.get("nextPageToken")
+        if page:
+            queue.append((fid, page))
+
     while queue:
-        fid = queue.pop(0)
-        if fid in seen:
-            continue
-        seen.add(fid)
-        page = None
-        while True:
-            res = drive.files().list(
-                q=f"'{fid}' in parents and trashed=false",
-                corpora="allDrives",
-                includeItemsFromAllDrives=True,
-                supportsAllDrives=True,
-                fields="files(id,name,mimeType),nextPageToken",
-                pageToken=page,
-                pageSize=200,
-            ).execute()
-            for f in res.get("files", []):
-                mt = f["mimeType"]
-                if mt == MIME_FOLDER:
-                    queue.append(f["id"])
-                elif mt in (MIME_DOC, MIME_SHEET, MIME_PDF):
-                    files.append(f)
-            page = res.get("nextPageToken")
-            if not page:
-                break
+        level = [queue.popleft() for _ in range(min(BATCH_SIZE, len(queue)))]
+        batch = drive.new_batch_http_request(callback=on_list)
+        for i, (fid, page) in enumerate(level):
+            batch.add(
+                drive.files().list(
+                    q=f"'{fid}' in parents and trashed=false",
+                    corpora="allDrives",
+                    includeItemsFromAllDrives=True,
+                    supportsAllDrives=True,
+                    fields="files(id,name,mimeType,modifiedTime,md5Checksum,parents),nextPageToken",
+                    pageToken=page,
+                    pageSize=200,
+                ),
+                request_id=str(i),
+            )
+        try:
+            batch.execute(http=thread_http())
+        except Exception as e:
+            # transport error / 5xx for the whole round trip: retry every listing in it
+            for item in level:
+                retry(item, e)
+        if failed:
+            raise RuntimeError(f"folder listing failed after retry ({failed[0]})")
     return files
 
+def dedupe_files(files: List[Dict]) -> List[Dict]:
+    """
+    Drop repeated files: the same id reached through several folders, and identical
+    uploads (same md5Checksum). Native Docs/Sheets have no checksum and are kept by id.
+    """
+    seen: Set[str] = set()
+    out = []
+    for f in files:
+        key = f.get("md5Checksum") or f["id"]
+        if key in seen or f["id"] in seen:
+            continue
+        seen.add(key); seen.add(f["id"])
+        out.append(f)
+    if len(out) < len(files):
+        print(f"[List] Skipped {len(files) - len(out)} duplicate files.")
+    return out
+
 def list_files(container_id: str) -> List[Dict]:
     """
     Try Shared Drive listing first (for IDs like 0AL5...), else fall back to folder recursion.
@@ -169,194 +278,811 @@ def list_files(container_id: str) -> List[Dict]:
         return []
 
 
+CHANGE_FIELDS = (
+    "nextPageToken,newStartPageToken,"
+    "changes(fileId,removed,file(id,name,mimeType,modifiedTime,md5Checksum,parents,trashed))"
+)
+
+def drive_start_token(drive_id: str) -> Optional[str]:
+    """
+    Start of the Shared Drive change feed, or None when the container is not a Shared Drive.
+    """
+    try:
+        return drive.changes().getStartPageToken(
+            driveId=drive_id, supportsAllDrives=True
+        ).execute(http=thread_http())["startPageToken"]
+    except Exception as e:
+        print(f"[List] No change feed for {drive_id}; every refresh relists: {e}")
+        return None
+
+def apply_drive_changes(raw: Dict[str, Dict], drive_id: str, token: str) -> Tuple[bool, str]:
+    """
+    Apply the Shared Drive changes since token to raw (file_id -> file), in place.
+    Returns (anything changed, token for the next poll).
+    """
+    changed = False
+    while True:
+        res = drive.changes().list(
+            pageToken=token,
+            driveId=drive_id,
+            includeItemsFromAllDrives=True,
+            supportsAllDrives=True,
+            fields=CHANGE_FIELDS,
+            pageSize=1000,
+        ).execute(http=thread_http())
+        for ch in res.get("changes", []):
+            fid, f = ch.get("fileId"), ch.get("file")
+            if not fid:
+                continue  # change to the drive itself
+            if ch.get("removed") or not f or f.pop("trashed", False) or f["mimeType"] not in (MIME_DOC, MIME_SHEET, MIME_PDF):
+                changed = raw.pop(fid, None) is not None or changed
+            else:
+                raw[fid] = f
+                changed = True
+        if "newStartPageToken" in res:
+            return changed, res["newStartPageToken"]
+        token = res["nextPageToken"]
+
+# The listing itself is cached for LISTING_TTL seconds. Once stale it is refreshed on a
+# background thread while the previous listing keeps serving requests. For a Shared Drive
+# the refresh reads only the change feed since the last poll instead of relisting.
+LISTING_TTL = int(os.environ.get("LISTING_TTL", "300"))
+_listing: Dict = {
+    "files": None, "version": "", "raw": None, "token": None, "feed": True, "fetched": 0.0, "refreshing": False,
+}
+_listing_lock = threading.Lock()
+
+def listing_version(files: List[Dict]) -> str:
+    """
+    Content version of a listing: a hash of its sorted (id, modifiedTime) pairs, so any edit,
+    upload, deletion, move-in or restore changes it. Computed once per listing refresh.
+    """
+    h = hashlib.sha256()
+    for fid, modified in sorted((f["id"], f.get("modifiedTime") or "") for f in files):
+        h.update(f"{fid}\0{modified}\0".encode())
+    return h.hexdigest()
+
+def refresh_listing() -> Tuple[List[Dict], str]:
+    try:
+        with _listing_lock:
+            files, version = _listing["files"], _listing["version"]
+            raw, token = _listing["raw"], _listing["token"]
+        changed = True
+        if raw and token:
+            try:
+                raw = dict(raw)
+                changed, token = apply_drive_changes(raw, DRIVE_CONTAINER_ID, token)
+            except Exception as e:
+                print(f"[List] Change feed failed; relisting: {e}")
+                token = None
+        if not (raw and token):
+            # token first, so changes made while listing are replayed on the next poll
+            token = drive_start_token(DRIVE_CONTAINER_ID) if _listing["feed"] else None
+            _listing["feed"] = token is not None
+            raw = {f["id"]: f for f in list_files(DRIVE_CONTAINER_ID)}
+        if changed or files is None:
+            files, edited = sync_file_listing(dedupe_files(list(raw.values())))
+            # tokenized once per listing instead of once per file per question
+            for f in files:
+                f["name_tokens"] = frozenset(toks(f["name"]))
+            version = listing_version(files)
+            if edited:
+                # files that were cached before an edit were worth reading once; re-read them
+                # now instead of on the next question that needs them
+                print(f"[Cache] Re-reading {len(edited)} edited files in the background.")
+                threading.Thread(target=ensure_chunks, args=(edited,), daemon=True).start()
+        with _listing_lock:
+            _listing["files"], _listing["version"], _listing["fetched"] = files, version, time.monotonic()
+            # an empty listing (Drive error) is never patched with deltas
+            _listing["raw"], _listing["token"] = raw, token if raw else None
+        return files, version
+    finally:
+        with _listing_lock:
+            _listing["refreshing"] = False
+
+def get_listing() -> Tuple[List[Dict], str]:
+    """
+    Return (files, listing_version(files)) for the current listing.
+    """
+    with _listing_lock:
+        files, version = _listing["files"], _listing["version"]
+        refresh = (
+            files is not None
+            and not _listing["refreshing"]
+            and time.monotonic() - _listing["fetched"] > LISTING_TTL
+        )
+        if refresh:
+            _listing["refreshing"] = True
+    if files is None:
+        return refresh_listing()
+    if refresh:
+        threading.Thread(target=refresh_listing, daemon=True).start()
+    return files, version
+
+
 # -----------------------------
 # Chunk generators
 # -----------------------------
-def iter_gdoc_chunks(file_id: str, name: str) -> Generator[Dict, None, None]:
+# Scoring is bag-of-words, so a few KB of text per chunk is plenty; longer pages and
+# paragraphs are split into several chunks, which keeps each chunk's share of the Gemini
+# context bounded without dropping text. (Sheet blocks are bounded by rows.)
+MAX_CHUNK_CHARS = 4096
+
+def split_text(text: str) -> List[str]:
+    """
+    Split normalized text into pieces of at most MAX_CHUNK_CHARS, at spaces where possible.
+    """
+    pieces = []
+    while len(text) > MAX_CHUNK_CHARS:
+        cut = text.rfind(" ", 0, MAX_CHUNK_CHARS + 1)
+        if cut <= 0:
+            cut = MAX_CHUNK_CHARS
+        pieces.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text:
+        pieces.append(text)
+    return pieces
+
+@dataclass(slots=True)
+class Chunk:
+    file_id: str
+    file_name: str
+    mime: str  # "gdoc" | "pdf" | "gsheet"
+    link: str
+    meta: Dict
+    text: str
+    tokens: str  # toks(text) joined by spaces, repeats kept: computed once, stored and indexed as is
+
+# Docs are exported as Markdown by default: the export is a fraction of the size of the
+# Docs JSON and headings survive as "#" lines. GDOC_EXPORT=0 falls back to reading the
+# document structure (batched documents.get) where exact heading styles matter.
+GDOC_EXPORT = os.environ.get("GDOC_EXPORT", "1") != "0"
+_MD_HEADING_RE = re.compile(r"^#{1,6}\s+(.*)$")
+_MD_MARKUP_RE = re.compile(r"\*\*|__|\\(?=[^\w\s])")
+# The export inlines images as "[imageN]: <data:image/png;base64,...>" definitions plus
+# "![][imageN]" references; neither (nor link targets) is text worth indexing.
+_MD_REF_DEF_RE = re.compile(r"^\s*\[[^\]]*\]:\s")
+_MD_IMAGE_RE = re.compile(r"!\[[^\]]*\](?:\[[^\]]*\]|\([^)]*\))")
+_MD_LINK_RE = re.compile(r"\[([^\]]*)\](?:\([^)]*\)|\[[^\]]*\])")
+_MD_AUTOLINK_RE = re.compile(r"<(?:https?|mailto):[^>]*>")
+# table separator rows ("| :---- | :---- |") and horizontal rules carry no words
+_MD_RULE_RE = re.compile(r"[\s|:-]*")
+
+def _md_line_text(line: str) -> str:
+    if _MD_REF_DEF_RE.match(line) or _MD_RULE_RE.fullmatch(line):
+        return ""
+    line = _MD_IMAGE_RE.sub("", line)
+    line = _MD_LINK_RE.sub(r"\1", line)
+    line = _MD_AUTOLINK_RE.sub("", line)
+    return _MD_MARKUP_RE.sub("", line).strip()
+
+# partial response: only the paragraph text runs and heading styles are read
+DOC_FIELDS = "body(content(paragraph(elements(textRun/content),paragraphStyle/namedStyleType)))"
+
+def _para_text(para: Dict) -> str:
+    text = "".join([e.get("textRun", {}).get("content", "") for e in para.get("elements", [])])
+    return text.strip()
+
+def _is_heading(para: Dict) -> bool:
+    return para.get("paragraphStyle", {}).get("namedStyleType", "").startswith("HEADING_")
+
+def fetch_docs(files: List[Dict]) -> Dict[str, Dict]:
+    """
+    Fetch many Google Docs with batched documents.get calls.
+    """
+    return batch_fetch(
+        docs, files,
+        lambda f: docs.documents().get(documentId=f["id"], fields=DOC_FIELDS),
+        "Docs",
+    )
+
+def iter_gdoc_chunks(file_id: str, name: str, doc: Optional[Dict] = None) -> Generator[Chunk, None, None]:
     """
     Parse Google Docs. Use named heading styles (HEADING_1..6) to set 'section'.
     Treat any line ending with '?' as a question and pair it with the next non-heading paragraph as the answer.
     """
     try:
-        doc = docs.documents().get(documentId=file_id).execute()
+        if doc is None:
+            with _api_slots:
+                doc = docs.documents().get(documentId=file_id, fields=DOC_FIELDS).execute(http=thread_http())
         content = doc.get("body", {}).get("content", [])
         current_section = "General"
+        link = f"https://docs.google.com/document/d/{file_id}/edit"
 
-        for i in range(len(content)):
-            c = content[i]
-            if "paragraph" not in c:
+        for i, c in enumerate(content):
+            para = c.get("paragraph")
+            if para is None:
                 continue
-            para = c["paragraph"]
-            elements = para.get("elements", [])
-            text = "".join([e.get("textRun", {}).get("content", "") for e in elements]).strip()
+            text = _para_text(para)
             if not text:
                 continue
 
-            style = para.get("paragraphStyle", {})
-            named = style.get("namedStyleType", "")
-            if named and named.startswith("HEADING_"):
+            if _is_heading(para):
                 current_section = text
                 continue
 
             if text.endswith("?"):
-                ans = ""
-                if i + 1 < len(content) and "paragraph" in content[i + 1]:
-                    nxt = content[i + 1]["paragraph"]
-                    nstyle = nxt.get("paragraphStyle", {})
-                    nnamed = nstyle.get("namedStyleType", "")
-                    if not (nnamed and nnamed.startswith("HEADING_")):
-                        ans = "".join([e.get("textRun", {}).get("content", "") for e in nxt.get("elements", [])]).strip()
+                nxt = content[i + 1].get("paragraph") if i + 1 < len(content) else None
+                ans = _para_text(nxt) if nxt is not None and not _is_heading(nxt) else ""
                 text = f"Question: {text} Answer: {ans}"
 
-            yield {
-                "file_id": file_id,
-                "file_name": name,
-                "mime": "gdoc",
-                "link": f"https://docs.google.com/document/d/{file_id}/edit",
-                "meta": {"section": current_section},
-                "text": norm(text),
-            }
+            for piece in split_text(norm(text)):
+                yield Chunk(
+                    file_id=file_id,
+                    file_name=name,
+                    mime="gdoc",
+                    link=link,
+                    meta={"section": current_section},
+                    text=piece,
+                    tokens=" ".join(toks(piece)),
+                )
     except Exception as e:
         print(f"[Docs] {name} ({file_id}) read error: {e}")
+        raise
 
-def iter_pdf_chunks(file_id: str, name: str) -> Generator[Dict, None, None]:
+def iter_gdoc_export_chunks(file_id: str, name: str) -> Generator[Chunk, None, None]:
+    """
+    Same chunking as iter_gdoc_chunks, over the Markdown export: '#' lines set 'section'
+    and a line ending with '?' is paired with the next non-heading line. If the export
+    fails (e.g. an image-heavy doc over the 10 MB export limit), the document structure
+    is read instead.
+    """
+    try:
+        with _api_slots:
+            raw = drive.files().export(fileId=file_id, mimeType="text/markdown").execute(http=thread_http())
+    except Exception as e:
+        print(f"[Docs] {name} ({file_id}) export failed, reading the document instead: {e}")
+        yield from iter_gdoc_chunks(file_id, name)
+        return
+    try:
+        lines = []
+        for line in raw.decode("utf-8-sig", errors="replace").splitlines():
+            line = _md_line_text(line)
+            if line:
+                m = _MD_HEADING_RE.match(line)
+                lines.append((m.group(1).strip(), True) if m else (line, False))
+        current_section = "General"
+        link = f"https://docs.google.com/document/d/{file_id}/edit"
+
+        for i, (text, heading) in enumerate(lines):
+            if heading:
+                if text:
+                    current_section = text
+                continue
+
+            if text.endswith("?"):
+                nxt = lines[i + 1] if i + 1 < len(lines) else None
+                ans = nxt[0] if nxt is not None and not nxt[1] else ""
+                text = f"Question: {text} Answer: {ans}"
+
+            for piece in split_text(norm(text)):
+                yield Chunk(
+                    file_id=file_id,
+                    file_name=name,
+                    mime="gdoc",
+                    link=link,
+                    meta={"section": current_section},
+                    text=piece,
+                    tokens=" ".join(toks(piece)),
+                )
+    except Exception as e:
+        print(f"[Docs] {name} ({file_id}) export error: {e}")
+        raise
+
+# PDF text extraction fans out across worker processes: PyMuPDF holds the GIL while
+# parsing, so threads would not help. Each task opens the document once and extracts
+# a contiguous page range; results are collected in page order with a bounded number
+# of in-flight tasks.
+PDF_WORKERS = min(os.cpu_count() or 1, 4)
+PDF_PAGES_PER_TASK = 8
+PDF_MAX_PENDING = 32
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # never fork: this process is a multi-threaded gunicorn worker, and a forked child
+            # can inherit a lock some other thread held. Workers run pdf_text.extract_pages,
+            # so they import only that side-effect-free module, never this one.
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _pdf_pool
+
+def _iter_pdf_pages(pdf_path: str, label: str) -> Generator[Tuple[int, str], None, None]:
+    with fitz.open(pdf_path, filetype="pdf") as pdf:
+        page_count = pdf.page_count
+    # small documents are not worth the inter-process round trip
+    if PDF_WORKERS < 2 or page_count <= PDF_PAGES_PER_TASK:
+        yield from extract_pages(pdf_path, 0, page_count, label)
+        return
+
+    pool = _get_pdf_pool()
+    pending = deque()
+    for start in range(0, page_count, PDF_PAGES_PER_TASK):
+        stop = min(start + PDF_PAGES_PER_TASK, page_count)
+        pending.append(pool.submit(extract_pages, pdf_path, start, stop, label))
+        if len(pending) >= PDF_MAX_PENDING:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+def iter_pdf_chunks(file_id: str, name: str) -> Generator[Chunk, None, None]:
+    """
+    Download the PDF to a temp file (not memory) and extract it page by page. Workers open
+    the file by path, so the document bytes are never copied between processes.
+    """
+    fh = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
     try:
         req = drive.files().get_media(fileId=file_id)
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, req)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-        fh.seek(0)
-        with fitz.open(stream=fh, filetype="pdf") as pdf:
-            for page_num, page in enumerate(pdf, start=1):
-                txt = norm(page.get_text() or "")
-                if not txt:
-                    continue
-                yield {
-                    "file_id": file_id,
-                    "file_name": name,
-                    "mime": "pdf",
-                    "link": f"https://drive.google.com/file/d/{file_id}/preview#page={page_num}",
-                    "meta": {"page": page_num},
-                    "text": txt,
-                }
+        req.http = thread_http()
+        with fh, _api_slots:
+            downloader = MediaIoBaseDownload(fh, req)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk()
+        for page_num, txt in _iter_pdf_pages(fh.name, f"{name} ({file_id})"):
+            for piece in split_text(txt):
+                yield Chunk(
+                    file_id=file_id,
+                    file_name=name,
+                    mime="pdf",
+                    link=f"https://drive.google.com/file/d/{file_id}/preview#page={page_num}",
+                    meta={"page": page_num},
+                    text=piece,
+                    tokens=" ".join(toks(piece)),
+                )
     except Exception as e:
         print(f"[PDF] {name} ({file_id}) read error: {e}")
+        raise
+    finally:
+        os.unlink(fh.name)
 
-def iter_sheet_chunks(file_id: str, name: str) -> Generator[Dict, None, None]:
+SHEET_RANGE = "A:ZZ"  # no sheet name: the first sheet, same as gspread's sheet1
+def fetch_sheet_rows(files: List[Dict]) -> Dict[str, List[List[str]]]:
+    """
+    Fetch the first-sheet values of many spreadsheets with batched values.get calls.
+    """
+    res = batch_fetch(
+        sheets, files,
+        lambda f: sheets.spreadsheets().values().get(spreadsheetId=f["id"], range=SHEET_RANGE),
+        "Sheet",
+    )
+    return {fid: r.get("values", []) for fid, r in res.items()}
+
+def iter_sheet_chunks(file_id: str, name: str, rows: Optional[List[List[str]]] = None) -> Generator[Chunk, None, None]:
     try:
-        sh = gspread_client.open_by_key(file_id).sheet1
-        rows = sh.get_all_values()
+        if rows is None:
+            with _api_slots:
+                rows = sheets.spreadsheets().values().get(
+                    spreadsheetId=file_id, range=SHEET_RANGE
+                ).execute(http=thread_http()).get("values", [])
+        link = f"https://docs.google.com/spreadsheets/d/{file_id}/edit"
         block, idx = [], 1
         for r in rows:
             line = norm(" | ".join(r))
             if line:
                 block.append(line)
             if len(block) >= 20:
-                yield {
-                    "file_id": file_id,
-                    "file_name": name,
-                    "mime": "gsheet",
-                    "link": f"https://docs.google.com/spreadsheets/d/{file_id}/edit",
-                    "meta": {"block": idx},
-                    "text": norm(" ".join(block)),
-                }
+                text = " ".join(block)  # lines are already normalized
+                yield Chunk(
+                    file_id=file_id,
+                    file_name=name,
+                    mime="gsheet",
+                    link=link,
+                    meta={"block": idx},
+                    text=text,
+                    tokens=" ".join(toks(text)),
+                )
                 block, idx = [], idx + 1
         if block:
-            yield {
-                "file_id": file_id,
-                "file_name": name,
-                "mime": "gsheet",
-                "link": f"https://docs.google.com/spreadsheets/d/{file_id}/edit",
-                "meta": {"block": idx},
-                "text": norm(" ".join(block)),
-            }
+            text = " ".join(block)
+            yield Chunk(
+                file_id=file_id,
+                file_name=name,
+                mime="gsheet",
+                link=link,
+                meta={"block": idx},
+                text=text,
+                tokens=" ".join(toks(text)),
+            )
     except Exception as e:
         print(f"[Sheet] {name} ({file_id}) read error: {e}")
+        raise
 
 
 # -----------------------------
-# Retrieval (heap keeps top-k)
+# On-disk cache: Drive listing + extracted chunks, invalidated by modifiedTime
 # -----------------------------
-def retrieve_top_chunks(question: str, max_files: int = 200, top_k: int = 3) -> Tuple[str, List[Dict]]:
-    files = list_files(DRIVE_CONTAINER_ID)
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH", "cache.sqlite")
+CHUNK_READERS = {
+    MIME_DOC: iter_gdoc_export_chunks if GDOC_EXPORT else iter_gdoc_chunks,
+    MIME_PDF: iter_pdf_chunks,
+    MIME_SHEET: iter_sheet_chunks,
+}
+CACHE_SCHEMA_VERSION = 6
+
+_cache_lock = threading.Lock()
+# Every gunicorn worker writes this file: WAL lets readers proceed during a write, and the
+# busy timeout makes a writer wait for the lock instead of failing with "database is locked".
+_cache_db = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False, timeout=30)
+_cache_db.execute("PRAGMA journal_mode=WAL")
+if _cache_db.execute("PRAGMA user_version").fetchone()[0] != CACHE_SCHEMA_VERSION:
+    # the cache is disposable: rebuild it rather than migrating
+    _cache_db.executescript("DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS chunks; DROP TABLE IF EXISTS meta; DROP TABLE IF EXISTS answers; DROP TABLE IF EXISTS events;")
+    _cache_db.execute(f"PRAGMA user_version = {CACHE_SCHEMA_VERSION}")
+_cache_db.executescript("""
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    mime TEXT,
+    modifiedTime TEXT,
+    md5 TEXT,  -- md5Checksum; only binary files (PDFs) have one
+    parents TEXT,
+    indexed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    file_id TEXT,
+    ord INTEGER,
+    mime TEXT,
+    link TEXT,
+    meta_json TEXT,
+    text TEXT,
+    tokens TEXT,  -- space-joined token list (with repeats) for the TF-IDF index
+    PRIMARY KEY (file_id, ord)
+);
+-- generation is bumped whenever cached chunks are added or removed; it lives in the
+-- database so every gunicorn worker sees changes made by the others
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+-- Gemini replies keyed by sha256(question + retrieved chunks); see cached_gemini_answer
+CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, text TEXT, ts INTEGER);
+-- Slack event_ids already handled by any worker; see seen_event
+CREATE TABLE IF NOT EXISTS events (id TEXT PRIMARY KEY, ts INTEGER);
+""")
+
+_BUMP_GENERATION = "UPDATE meta SET value = value + 1 WHERE key = 'generation'"
+
+def cache_generation() -> int:
+    with _cache_lock:
+        return _cache_db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+def sync_file_listing(files: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Record the live Drive listing. Files whose modifiedTime changed lose their cached chunks,
+    unless their content checksum is unchanged (e.g. a renamed PDF); files no longer listed
+    are dropped. If Drive returned nothing, serve the cached listing.
+    Returns (files, edited files whose cached chunks were just dropped).
+    """
+    with _cache_lock, _cache_db:
+        if not files:
+            rows = _cache_db.execute("SELECT id, name, mime, modifiedTime FROM files").fetchall()
+            if rows:
+                print(f"[Cache] Drive listing empty; using {len(rows)} cached files.")
+            return [{"id": r[0], "name": r[1], "mimeType": r[2], "modifiedTime": r[3]} for r in rows], []
+
+        _cache_db.executemany(
+            """
+            INSERT INTO files (id, name, mime, modifiedTime, md5, parents, indexed) VALUES (?, ?, ?, ?, ?, ?, 0)
+            ON CONFLICT(id) DO UPDATE SET
+                name = excluded.name,
+                mime = excluded.mime,
+                parents = excluded.parents,
+                indexed = CASE
+                    WHEN files.modifiedTime IS excluded.modifiedTime THEN files.indexed
+                    WHEN excluded.md5 IS NOT NULL AND files.md5 IS excluded.md5 THEN files.indexed
+                    ELSE 0 END,
+                modifiedTime = excluded.modifiedTime,
+                md5 = excluded.md5
+            """,
+            [(f["id"], f["name"], f["mimeType"], f.get("modifiedTime"), f.get("md5Checksum"),
+              json.dumps(f.get("parents", [])))
+             for f in files],
+        )
+        live = {f["id"] for f in files}
+        gone = [(r[0],) for r in _cache_db.execute("SELECT id FROM files") if r[0] not in live]
+        _cache_db.executemany("DELETE FROM files WHERE id = ?", gone)
+        edited = {r[0] for r in _cache_db.execute(
+            "SELECT DISTINCT c.file_id FROM chunks c JOIN files f ON f.id = c.file_id WHERE f.indexed = 0"
+        )}
+        stale = _cache_db.execute(
+            "DELETE FROM chunks WHERE file_id NOT IN (SELECT id FROM files WHERE indexed = 1)"
+        ).rowcount
+        if gone or stale:
+            _cache_db.execute(_BUMP_GENERATION)
+    return files, [f for f in files if f["id"] in edited]
+
+def is_file_cached(fid: str) -> bool:
+    with _cache_lock:
+        row = _cache_db.execute("SELECT indexed FROM files WHERE id = ?", (fid,)).fetchone()
+    return bool(row and row[0])
+
+def ensure_file_chunks(f: Dict, reader=None) -> bool:
+    """
+    Extract and store a file's chunks unless the cache already holds them for its modifiedTime.
+    Read errors are not cached so the file is retried on the next request.
+    Returns False if the file could not be read.
+    """
+    fid = f["id"]
+    if is_file_cached(fid):
+        return True
+
+    reader = reader or CHUNK_READERS.get(f["mimeType"])
+    if not reader:
+        return False
+    try:
+        chunks = list(reader(fid, f["name"]))
+    except Exception:
+        return False
+
+    with _cache_lock, _cache_db:
+        _cache_db.execute("DELETE FROM chunks WHERE file_id = ?", (fid,))
+        _cache_db.executemany(
+            "INSERT INTO chunks (file_id, ord, mime, link, meta_json, text, tokens) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(fid, i, ch.mime, ch.link, json.dumps(ch.meta), ch.text, ch.tokens)
+             for i, ch in enumerate(chunks)],
+        )
+        _cache_db.execute(
+            "UPDATE files SET indexed = 1 WHERE id = ? AND modifiedTime IS ?", (fid, f.get("modifiedTime"))
+        )
+        _cache_db.execute(_BUMP_GENERATION)
+    return True
+
+
+# One pool shared by all requests: no per-question thread start-up, and total fetch
+# concurrency stays bounded when several Slack questions arrive at once.
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "16"))
+_fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="fetch")
+
+def ensure_chunks(files: List[Dict]) -> bool:
+    """
+    Bring every file's chunks into the cache. Downloads are I/O-bound, so uncached files
+    are extracted on a thread pool; each worker stores its own results under the cache lock.
+    Returns False if any file could not be read (its batch call or its reader failed).
+    """
+    pending = [f for f in files if not is_file_cached(f["id"])]
+    # uncached Docs (structure mode) and Sheets are fetched up front in batched round trips;
+    # PDF media and Docs exports (which batch requests cannot carry) are downloaded per file
+    doc_bodies = {} if GDOC_EXPORT else fetch_docs([f for f in pending if f["mimeType"] == MIME_DOC])
+    sheet_rows = fetch_sheet_rows([f for f in pending if f["mimeType"] == MIME_SHEET])
+    jobs = []
+    for f in pending:
+        fid, mt = f["id"], f["mimeType"]
+        if mt == MIME_DOC and fid in doc_bodies:
+            jobs.append((f, partial(iter_gdoc_chunks, doc=doc_bodies[fid])))
+        elif mt == MIME_SHEET and fid in sheet_rows:
+            jobs.append((f, partial(iter_sheet_chunks, rows=sheet_rows[fid])))
+        elif mt == MIME_PDF or (mt == MIME_DOC and GDOC_EXPORT):
+            jobs.append((f, None))
+    futures = [_fetch_pool.submit(ensure_file_chunks, f, reader) for f, reader in jobs]
+    complete = len(jobs) == len(pending)
+    for fut in as_completed(futures):
+        complete = fut.result() and complete
+    return complete
+
+
+# -----------------------------
+# TF-IDF index over cached chunks
+# -----------------------------
+_index_lock = threading.Lock()
+_index: Dict = {"generation": -1, "files": {}}
+
+# Term counts come from a stateless hasher, so a file's rows never need refitting: after a
+# cache change only new or modified files are hashed, and the IDF weights are recomputed
+# from the stacked counts (a column count, far cheaper than re-tokenizing the corpus).
+# The stored token lists are already tokenized by toks(), so the analyzer is a plain split.
+_hasher = HashingVectorizer(
+    analyzer=str.split, n_features=2 ** 20, alternate_sign=False, norm=None, dtype=np.float32
+)
+
+def _load_file_entry(fid: str, name: str) -> Tuple[List[Chunk], Optional[sp.csr_matrix]]:
+    """
+    Read one file's cached chunks (caller holds _cache_lock) and hash their term counts.
+    """
+    chunks = [
+        # interned so every chunk of a file shares one string object per field
+        Chunk(
+            file_id=sys.intern(fid),
+            file_name=sys.intern(name),
+            mime=sys.intern(mime),
+            link=sys.intern(link),
+            meta=json.loads(meta_json),
+            text=text,
+            tokens=tokens,
+        )
+        for mime, link, meta_json, text, tokens in _cache_db.execute(
+            "SELECT mime, link, meta_json, text, tokens FROM chunks WHERE file_id = ? ORDER BY ord", (fid,)
+        )
+    ]
+    if not chunks:
+        return chunks, None
+    counts = _hasher.transform([ch.tokens for ch in chunks])
+    # sublinear tf (1 + log tf): a term repeated throughout a long page or table block
+    # should not outweigh a rarer term that also matches the question
+    np.log(counts.data, out=counts.data)
+    counts.data += 1
+    return chunks, counts
+
+def get_index() -> Dict:
+    """
+    Return the TF-IDF index over all cached chunks, updating it only when the cache has changed.
+    postings: the L2-normalized TF-IDF matrix (chunks x hashed terms) in CSC form, i.e. one
+    posting list (chunk ids + weights) per term; idf: per-term weights for the query;
+    file_codes: per-chunk file number for restricting a query to the prefiltered files.
+    """
+    global _index
+    with _index_lock:
+        generation = cache_generation()
+        if _index["generation"] == generation:
+            return _index
+        old, files = _index["files"], {}
+        with _cache_lock:
+            for fid, name, modified in _cache_db.execute(
+                "SELECT id, name, modifiedTime FROM files WHERE indexed = 1 ORDER BY id"
+            ).fetchall():
+                key = (fid, name, modified)
+                files[key] = old[key] if key in old else _load_file_entry(fid, name)
+
+        # Identical chunk texts (shared templates, headers/footers, copied sections) are
+        # indexed once; the other files' copies are remembered (by file number) so the file
+        # filter in rank_chunks still lets the chunk through for them, citing their copy.
+        chunks: List[Chunk] = []
+        file_code: Dict[str, int] = {}
+        codes: List[int] = []
+        first_cid: Dict[str, int] = {}
+        also_in: Dict[int, Dict[int, Chunk]] = {}
+        blocks = []
+        for (fid, _, _), (file_chunks, counts) in files.items():
+            if counts is None:
+                continue
+            code = file_code.setdefault(fid, len(file_code))
+            rows = []
+            for i, ch in enumerate(file_chunks):
+                cid = first_cid.setdefault(ch.text, len(chunks))
+                if cid == len(chunks):
+                    chunks.append(ch)
+                    codes.append(code)
+                    rows.append(i)
+                elif codes[cid] != code:
+                    also_in.setdefault(cid, {}).setdefault(code, ch)
+            if rows:
+                blocks.append(counts if len(rows) == len(file_chunks) else counts[rows])
+
+        postings, idf = None, None
+        if blocks:
+            counts = sp.vstack(blocks, format="csr")
+            # same weighting as TfidfVectorizer(sublinear_tf=True): smooth idf, l2 rows
+            df = np.bincount(counts.indices, minlength=counts.shape[1])
+            idf = (np.log((1 + counts.shape[0]) / (1 + df)) + 1).astype(np.float32)
+            idf[df == 0] = 0.0  # terms absent from the corpus must not dilute the query norm
+            weighted = counts.multiply(idf).tocsr()
+            if weighted.nnz:
+                postings = normalize(weighted, norm="l2", copy=False).tocsc()
+
+        _index = {
+            "generation": generation,
+            "files": files,
+            "chunks": chunks,
+            "idf": idf,
+            "postings": postings,
+            "file_code": file_code,
+            "file_codes": np.asarray(codes, dtype=np.int32),
+            "also_in": also_in,
+        }
+        return _index
+
+def rank_chunks(index: Dict, query_tokens: FrozenSet[str], file_ids: Set[str], top_k: int) -> List[Tuple[float, Chunk]]:
+    """
+    Cosine-rank chunks of file_ids against the query. Only the posting lists of the query
+    terms are read, so the work scales with the matched postings rather than the corpus.
+    Returns (score, chunk), best first; a deduplicated chunk is returned as the copy held
+    by one of file_ids, so it is cited from a file the question was allowed to use.
+    """
+    if index["postings"] is None or not query_tokens:
+        return []
+    q = _hasher.transform([" ".join(query_tokens)])
+    q.data *= index["idf"][q.indices]
+    q.eliminate_zeros()
+    if not q.nnz:
+        return []
+    q = normalize(q, norm="l2", copy=False)
+    cols = index["postings"][:, q.indices]
+    weights = cols.data * np.repeat(q.data, np.diff(cols.indptr))
+    cand, inverse = np.unique(cols.indices, return_inverse=True)
+    scores = np.bincount(inverse, weights=weights)
+    codes = [index["file_code"][fid] for fid in file_ids if fid in index["file_code"]]
+    keep = np.isin(index["file_codes"][cand], codes)
+    wanted = set(codes)
+    if index["also_in"]:
+        for j in np.flatnonzero(~keep):
+            extra = index["also_in"].get(int(cand[j]))
+            if extra and not wanted.isdisjoint(extra):
+                keep[j] = True
+    cand, scores = cand[keep], scores[keep]
+
+    if len(cand) > top_k:
+        part = np.argpartition(-scores, top_k)[:top_k]
+        cand, scores = cand[part], scores[part]
+    order = np.argsort(-scores, kind="stable")
+    out = []
+    for i in order:
+        cid = int(cand[i])
+        ch = index["chunks"][cid]
+        if int(index["file_codes"][cid]) not in wanted:
+            copies = index["also_in"][cid]
+            ch = copies[min(wanted.intersection(copies))]
+        out.append((float(scores[i]), ch))
+    return out
+
+
+# -----------------------------
+# Retrieval
+# -----------------------------
+MIN_SCORE = float(os.environ.get("MIN_SCORE", "0.05"))  # cosine; below this Gemini is not called
+CONTEXT_TOKENS = int(os.environ.get("CONTEXT_TOKENS", "4000"))
+
+def approx_tokens(text: str) -> int:
+    """
+    Gemini token estimate without an API round trip: about 4 ASCII characters per token,
+    and one token per non-ASCII character (CJK runs ~1 token per character; accented Latin
+    is overcounted, which only errs toward a smaller context).
+    """
+    ascii_chars = len(text.encode("ascii", errors="ignore"))
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+def retrieve_top_chunks(question: str, files: List[Dict], max_files: int = 200, top_k: int = 3) -> Tuple[str, List[Chunk], float, bool]:
+    """
+    Return (context, top chunks best first, best score, complete). Chunks scoring below
+    MIN_SCORE are dropped, so an empty result means nothing in Drive is worth sending to
+    Gemini. complete is False when a file that was searched could not be read, so the
+    result may change once Drive recovers.
+    """
     if not files:
         print("[Retrieve] No files found under container ID. Verify the service account has access to the Shared Drive.")
-        return "", []
-
-    # quick prefilter by filename overlap — add a numeric tiebreaker to avoid dict comparison
-    qtok = toks(question)
-    scored = [(-overlap(qtok, f["name"]), i, f) for i, f in enumerate(files)]
-    heapq.heapify(scored)
-    chosen = [heapq.heappop(scored)[2] for _ in range(min(max_files, len(scored)))]
-
-    heap: List[Tuple[int, int, Dict]] = []
-    tiebreak = 0
-
-    def push(ch: Dict):
-        nonlocal heap, tiebreak
-        sc = overlap(qtok, ch["text"])
-        if sc < 0:
-            sc = 0
-        if len(heap) < top_k:
-            heapq.heappush(heap, (sc, tiebreak, ch))
-        else:
-            if sc > heap[0][0]:
-                heapq.heapreplace(heap, (sc, tiebreak, ch))
-        tiebreak += 1
-
-    for f in chosen:
-        mt, fid, name = f["mimeType"], f["id"], f["name"]
-        gen = None
-        if mt == MIME_DOC:
-            gen = iter_gdoc_chunks(fid, name)
-        elif mt == MIME_PDF:
-            gen = iter_pdf_chunks(fid, name)
-        elif mt == MIME_SHEET:
-            gen = iter_sheet_chunks(fid, name)
-        if not gen:
-            continue
-        for ch in gen:
-            push(ch)
-
-    # Fallback: ensure Gemini always has at least 1 chunk
-    if not heap:
-        for f in chosen[:5]:
-            mt, fid, name = f["mimeType"], f["id"], f["name"]
-            gen = (
-                iter_gdoc_chunks(fid, name) if mt == MIME_DOC
-                else iter_pdf_chunks(fid, name) if mt == MIME_PDF
-                else iter_sheet_chunks(fid, name) if mt == MIME_SHEET
-                else None
-            )
-            if not gen:
-                continue
-            try:
-                ch = next(gen)
-                push(ch)
-            except StopIteration:
-                continue
+        return "", [], 0.0, False
 
-    if not heap:
-        return "", []
+    # quick prefilter by filename overlap — keyed on the score alone, so files are never compared
+    qtok = frozenset(toks(question))
+    ranked_files = heapq.nlargest(
+        max_files,
+        ((overlap(qtok, f["name_tokens"]), f) for f in files),
+        key=lambda sf: sf[0],
+    )
+    chosen = [f for _, f in ranked_files]
+
+    # Files whose name shares no query token are only downloaded if the name matches
+    # alone cannot fill top_k; ones already in the cache cost nothing and are always used.
+    positive = [f for sc, f in ranked_files if sc > 0]
+    zero = [f for sc, f in ranked_files if sc == 0]
+    complete = ensure_chunks(positive)
+    inv = get_index()
+    ranked = rank_chunks(inv, qtok, {f["id"] for f in chosen}, top_k)
+    if len(ranked) < top_k and not all(is_file_cached(f["id"]) for f in zero):
+        complete = ensure_chunks(zero) and complete
+        inv = get_index()
+        ranked = rank_chunks(inv, qtok, {f["id"] for f in chosen}, top_k)
+    ranked = [(sc, ch) for sc, ch in ranked if sc >= MIN_SCORE]
+    if not ranked:
+        return "", [], 0.0, complete
+    top = [ch for _, ch in ranked]
 
-    top = [h[2] for h in sorted(heap, key=lambda x: (-x[0], x[1]))]
-    # compact context (~8k cap)
+    # compact context, bounded by the token budget rather than characters
     ctx, total = [], 0
     for ch in top:
-        part = f"Source: {ch['file_name']}\nContent: {ch['text']}\n"
-        if total + len(part) > 8000:
+        part = f"Source: {ch.file_name}\nContent: {ch.text}\n"
+        cost = approx_tokens(part)
+        if total + cost > CONTEXT_TOKENS:
             break
-        ctx.append(part); total += len(part)
-    return "\n".join(ctx), top
+        ctx.append(part); total += cost
+    return "\n".join(ctx), top, ranked[0][0], complete
 
 
 # -----------------------------
 # Answer + single citation
 # -----------------------------
-def citation_for(ch: Dict) -> str:
-    name, link, meta, mime = ch["file_name"], ch["link"], ch.get("meta", {}), ch["mime"]
+def citation_for(ch: Chunk) -> str:
+    name, link, meta, mime = ch.file_name, ch.link, ch.meta, ch.mime
     if mime == "pdf":
         return f'(Source: [{name}]({link}), on page {meta.get("page")})'
     if mime == "gdoc":
@@ -366,37 +1092,173 @@ def citation_for(ch: Dict) -> str:
         return f'(Source: [{name}]({link}), in data block {meta.get("block")})'
     return f'(Source: [{name}]({link}))'
 
-def answer(user_q: str) -> str:
-    context, chunks = retrieve_top_chunks(user_q, max_files=200, top_k=3)
-    if not context or not chunks:
-        return "I cannot answer this question as the information is not in the provided documents."
+NO_ANSWER = "I cannot answer this question as the information is not in the provided documents."
+
+# Answers are cached per question key and listing version, so any edit, upload or
+# deletion in Drive naturally evicts stale answers.
+ANSWER_CACHE_SIZE = 512
+_answer_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+_answer_cache_lock = threading.Lock()
+
+def question_key(user_q: str) -> str:
+    """
+    Cache key for a question: lowercased, whitespace-collapsed, with surrounding punctuation
+    trimmed. Word order and stopwords are kept, since Gemini sees the full question
+    ("Does Alice report to Bob?" and "Does Bob report to Alice?" must not share an answer).
+    """
+    return norm(user_q.lower()).strip(string.punctuation + " ")
+
+def answer(user_q: str, on_partial: Optional[Callable[[str], None]] = None) -> str:
+    files, version = get_listing()
+    key = (question_key(user_q), version)
+    with _answer_cache_lock:
+        if key in _answer_cache:
+            _answer_cache.move_to_end(key)
+            return _answer_cache[key]
+
+    reply, cacheable = generate_answer(user_q, files, on_partial)
+    if cacheable:
+        with _answer_cache_lock:
+            _answer_cache[key] = reply
+            if len(_answer_cache) > ANSWER_CACHE_SIZE:
+                _answer_cache.popitem(last=False)
+    return reply
+
+# Second level, shared by all workers and kept across restarts: Gemini replies keyed by
+# the question and the exact chunks it was shown. A question asked after an unrelated
+# Drive edit misses the per-listing cache above but still hits here.
+ANSWER_TTL = int(os.environ.get("ANSWER_TTL", str(7 * 24 * 3600)))
+
+def answer_key(user_q: str, chunks: List[Chunk]) -> str:
+    h = hashlib.sha256(question_key(user_q).encode())
+    for ch in chunks:
+        h.update(b"\0" + ch.file_id.encode() + b"\0" + ch.text.encode())
+    return h.hexdigest()
+
+def cached_gemini_answer(key: str) -> Optional[str]:
+    with _cache_lock:
+        row = _cache_db.execute(
+            "SELECT text FROM answers WHERE key = ? AND ts >= ?", (key, int(time.time()) - ANSWER_TTL)
+        ).fetchone()
+    return row[0] if row else None
+
+def store_gemini_answer(key: str, text: str) -> None:
+    now = int(time.time())
+    with _cache_lock, _cache_db:
+        _cache_db.execute("INSERT OR REPLACE INTO answers (key, text, ts) VALUES (?, ?, ?)", (key, text, now))
+        _cache_db.execute("DELETE FROM answers WHERE ts < ?", (now - ANSWER_TTL,))
+
+GEMINI_TIMEOUT = 30  # seconds; bounds the life of the Slack worker thread
+STREAM_UPDATE_INTERVAL = 0.75  # seconds between partial-answer updates
+
+def generate_answer(
+    user_q: str, files: List[Dict], on_partial: Optional[Callable[[str], None]] = None
+) -> Tuple[str, bool]:
+    """
+    Stream the Gemini answer; on_partial receives the accumulated text at most every
+    STREAM_UPDATE_INTERVAL seconds so the caller can show it before generation finishes.
+    Returns (reply, cacheable): replies caused by a Gemini error, or built while some
+    searched file could not be read, must not be cached.
+    """
+    context, chunks, _, complete = retrieve_top_chunks(user_q, files, max_files=200, top_k=3)
+    if not chunks:
+        # nothing relevant: skip the Gemini round trip entirely (and remember that, unless
+        # a read failure may have hidden the relevant file)
+        return NO_ANSWER, complete
+    key = answer_key(user_q, chunks)
+    cached = cached_gemini_answer(key)
+    if cached is not None:
+        return cached, complete
 
     prompt = f"CONTEXT:\n{context}\n\nQUESTION: {user_q}\n\nANSWER:"
     try:
-        resp = gemini.generate_content(prompt)
-        text = norm(getattr(resp, "text", "") or "")
-        if not text or text.lower().startswith("i cannot answer"):
-            return "I cannot answer this question as the information is not in the provided documents."
+        deadline = time.monotonic() + GEMINI_TIMEOUT
+        resp = gemini.generate_content(prompt, stream=True, request_options={"timeout": GEMINI_TIMEOUT})
+        parts, last_update = [], time.monotonic()
+        for part in resp:
+            parts.append(part.text)
+            now = time.monotonic()
+            if now > deadline:
+                raise TimeoutError(f"no complete answer after {GEMINI_TIMEOUT}s")
+            if on_partial and now - last_update >= STREAM_UPDATE_INTERVAL:
+                on_partial("".join(parts))
+                last_update = now
+        text = norm("".join(parts))
     except Exception as e:
         print(f"[Gemini] error: {e}")
-        return "I cannot answer this question as the information is not in the provided documents."
+        return NO_ANSWER, False
 
-    best = chunks[0]  # highest scoring chunk
-    return f"{text} {citation_for(best)}"
+    if not text or text.lower().startswith("i cannot answer"):
+        reply = NO_ANSWER
+    else:
+        reply = f"{text} {citation_for(chunks[0])}"  # cite the highest scoring chunk
+    store_gemini_answer(key, reply)
+    return reply, complete
 
 
 # -----------------------------
 # Slack Events
 # -----------------------------
+PLACEHOLDER_TEXT = "_Looking through the documents…_"
+# Mentions are answered off the request thread so Slack gets its 200 immediately; a shared
+# pool caps how many answers one worker builds at once (a burst queues instead of spawning
+# a thread per event).
+MENTION_WORKERS = int(os.environ.get("MENTION_WORKERS", "8"))
+_mention_pool = ThreadPoolExecutor(max_workers=MENTION_WORKERS, thread_name_prefix="mention")
+
 def handle_mention(channel_id: str, raw_text: str):
-    q = re.sub(r"<@[^>]+>", "", raw_text).strip()
+    q = _MENTION_RE.sub("", raw_text).strip()
     if not q:
         return
-    reply = answer(q)
+    ts = None
+
+    def post(text: str):
+        # first call posts the message; later calls edit it in place
+        nonlocal ts
+        try:
+            if ts is None:
+                ts = slack.chat_postMessage(channel=channel_id, text=text)["ts"]
+            else:
+                slack.chat_update(channel=channel_id, ts=ts, text=text)
+        except SlackApiError as e:
+            print(f"[Slack] post error: {e.response.get('error')}")
+
+    # acknowledge right away; retrieval, partial answers and the final reply edit this message
+    post(PLACEHOLDER_TEXT)
+    try:
+        reply = answer(q, on_partial=post)
+    except Exception as e:
+        # runs on the mention pool, whose futures nobody reads: log here and always
+        # replace the placeholder
+        print(f"[Slack] answer failed: {e!r}")
+        reply = NO_ANSWER
+    post(reply)
+
+# Slack can replay an event without X-Slack-Retry-Num, and the replay may reach another
+# gunicorn worker; recent event_ids are therefore recorded in the shared cache database.
+# The ack path has its own connection and lock: _cache_lock can be held for seconds while
+# get_index loads the cache, and Slack redelivers events not acknowledged within 3 s.
+# The short busy timeout bounds the wait for another worker's write the same way.
+SEEN_EVENTS_TTL = 3600  # seconds; Slack gives up retrying long before this
+_events_lock = threading.Lock()
+_events_db = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False, timeout=1)
+
+def seen_event(event_id: str) -> bool:
+    """
+    Return True if event_id was already handled (by any worker); otherwise record it.
+    """
+    now = int(time.time())
     try:
-        slack.chat_postMessage(channel=channel_id, text=reply)
-    except SlackApiError as e:
-        print(f"[Slack] post error: {e.response.get('error')}")
+        with _events_lock, _events_db:
+            inserted = _events_db.execute(
+                "INSERT OR IGNORE INTO events (id, ts) VALUES (?, ?)", (event_id, now)
+            ).rowcount
+            _events_db.execute("DELETE FROM events WHERE ts < ?", (now - SEEN_EVENTS_TTL,))
+    except sqlite3.Error as e:
+        # better a rare duplicate reply than dropping the question
+        print(f"[Slack] event dedupe unavailable: {e}")
+        return False
+    return inserted == 0
 
 @app.route("/slack/events", methods=["POST"])
 def slack_events():
@@ -406,12 +1268,15 @@ def slack_events():
     # avoid duplicate replies on Slack retries
     if request.headers.get("X-Slack-Retry-Num"):
         return Response(status=200)
+    event_id = data.get("event_id")
+    if event_id and seen_event(event_id):
+        return Response(status=200)
 
     event = data.get("event", {})
     if event.get("type") == "app_mention":
         channel_id = event.get("channel", "")
         text = event.get("text", "")
-        threading.Thread(target=handle_mention, args=(channel_id, text), daemon=True).start()
+        _mention_pool.submit(handle_mention, channel_id, text)
 
     return Response(status=200)
 
@@ -419,6 +1284,7 @@ def slack_events():
 def index():
     return "✅ ConahGPT is running."
 
+# Local development only; production runs under gunicorn (see render.yaml).
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", "8080"))
     app.run(host="0.0.0.0", port=port)
@@ -1,10 +1,11 @@
 import os
-import io
-import gspread
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import fitz  # PyMuPDF
+import httplib2
+import google_auth_httplib2
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
 
 # Service account credentials file
 SERVICE_ACCOUNT_FILE = 'conah-gpt-creds.json'
@@ -21,78 +22,106 @@ creds = service_account.Credentials.from_service_account_file(
     scopes=SCOPES
 )
 
-gspread_client = gspread.authorize(creds)
-drive_service = build('drive', 'v3', credentials=creds)
-docs_service = build('docs', 'v1', credentials=creds)
+sheets_service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
+drive_service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+docs_service = build('docs', 'v1', credentials=creds, cache_discovery=False)
+
+# httplib2.Http is not thread-safe: each reader thread gets its own authorized connection
+_local = threading.local()
+
+def _thread_http():
+    if not hasattr(_local, "http"):
+        _local.http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=60))
+    return _local.http
+
+# Reads are network-bound, so files are downloaded concurrently
+READ_WORKERS = 16
+
+# file_id -> (modifiedTime, extracted text); a file is only downloaded again once it changes
+_text_cache = {}
 
 def list_all_files_in_folder(folder_id):
     """Return all files (of any type) in a folder."""
     query = f"'{folder_id}' in parents"
-    results = drive_service.files().list(q=query, fields="files(id, name, mimeType)").execute()
+    results = drive_service.files().list(q=query, fields="files(id, name, mimeType, modifiedTime)").execute()
     return results.get('files', [])
 
 def read_google_sheet(file_id):
     try:
-        sheet = gspread_client.open_by_key(file_id).sheet1
-        records = sheet.get_all_records()
+        # one values request for the first sheet (what gspread's sheet1 read took two calls for);
+        # formatted values (the default), so dates, percentages and currency read as displayed
+        result = sheets_service.spreadsheets().values().get(
+            spreadsheetId=file_id, range="A:ZZ"
+        ).execute(http=_thread_http())
+        rows = result.get("values", [])
+        if not rows:
+            return ""
+        header = rows[0]
+        records = [dict(zip(header, row + [""] * (len(header) - len(row)))) for row in rows[1:]]
         return "\n".join([str(row) for row in records])
     except Exception as e:
         return f"Error reading sheet: {e}"
 
 def read_google_doc(file_id):
     try:
-        doc = docs_service.documents().get(documentId=file_id).execute()
+        doc = docs_service.documents().get(documentId=file_id).execute(http=_thread_http())
         content = doc.get("body", {}).get("content", [])
-        text = ""
+        parts = []
         for c in content:
             p = c.get("paragraph")
             if p:
                 for el in p.get("elements", []):
-                    text += el.get("textRun", {}).get("content", "")
-        return text
+                    parts.append(el.get("textRun", {}).get("content", ""))
+        return "".join(parts)
     except Exception as e:
         return f"Error reading doc: {e}"
 
 def read_pdf(file_id):
     try:
-        request = drive_service.files().get_media(fileId=file_id)
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-        fh.seek(0)
-        text = ""
-        with fitz.open(stream=fh, filetype="pdf") as pdf:
-            for page in pdf:
-                text += page.get_text()
-        return text
+        # one plain GET for the whole file instead of the chunked download protocol;
+        # fitz reads the returned bytes directly, without a BytesIO copy
+        data = drive_service.files().get_media(fileId=file_id).execute(http=_thread_http())
+        # plain-text mode without image blocks or reading-order sort, same as app.py
+        with fitz.open(stream=data, filetype="pdf") as pdf:
+            return "".join([
+                page.get_text("text", flags=fitz.TEXT_MEDIABOX_CLIP, sort=False) for page in pdf
+            ])
     except Exception as e:
         return f"Error reading PDF: {e}"
 
+def _read_one(file):
+    file_id = file['id']
+    name = file['name']
+    mime = file['mimeType']
+    modified = file.get('modifiedTime')
+    text = ""
+
+    cached = _text_cache.get(file_id)
+    if modified and cached and cached[0] == modified:
+        text = cached[1]
+    elif mime == 'application/vnd.google-apps.spreadsheet':
+        text = read_google_sheet(file_id)
+    elif mime == 'application/vnd.google-apps.document':
+        text = read_google_doc(file_id)
+    elif mime == 'application/pdf':
+        text = read_pdf(file_id)
+    else:
+        text = f"Unsupported file type: {mime}"
+
+    # read errors are not cached so the file is retried next time
+    if modified and not text.startswith("Error reading"):
+        _text_cache[file_id] = (modified, text)
+
+    return {
+        "file_name": name,
+        "mime_type": mime,
+        "content": text
+    }
+
 def extract_all_text_from_folder(folder_id):
     files = list_all_files_in_folder(folder_id)
-    results = []
-
-    for file in files:
-        file_id = file['id']
-        name = file['name']
-        mime = file['mimeType']
-        text = ""
-
-        if mime == 'application/vnd.google-apps.spreadsheet':
-            text = read_google_sheet(file_id)
-        elif mime == 'application/vnd.google-apps.document':
-            text = read_google_doc(file_id)
-        elif mime == 'application/pdf':
-            text = read_pdf(file_id)
-        else:
-            text = f"Unsupported file type: {mime}"
-
-        results.append({
-            "file_name": name,
-            "mime_type": mime,
-            "content": text
-        })
-
-    return results
+    if not files:
+        return []
+    # map keeps the listing order
+    with ThreadPoolExecutor(max_workers=min(READ_WORKERS, len(files))) as executor:
+        return list(executor.map(_read_one, files))
@@ -0,0 +1,33 @@
+# pdf_text.py
+# PDF page extraction run by app.py's worker processes. Workers are started with forkserver
+# or spawn and import this module, never app.py: it must stay free of import-time side
+# effects (API clients, the cache database, thread pools).
+from typing import List, Tuple
+
+import fitz  # PyMuPDF
+
+# Cheapest plain-text mode: whitespace is collapsed below anyway, ligatures are expanded
+# (better tokens), and image blocks are never produced. sort=False skips the reading-order sort.
+PDF_TEXT_FLAGS = fitz.TEXT_MEDIABOX_CLIP
+
+def extract_pages(pdf_path: str, start: int, stop: int, label: str) -> List[Tuple[int, str]]:
+    """
+    Return (page_num, normalized_text) for pages [start, stop). label names the Drive file
+    in log lines (pdf_path is only a temp file).
+    """
+    out = []
+    with fitz.open(pdf_path, filetype="pdf") as pdf:
+        for i in range(start, stop):
+            try:
+                page = pdf.load_page(i)
+                text = page.get_text("text", flags=PDF_TEXT_FLAGS, sort=False) or ""
+            except Exception as e:
+                # one corrupt page must not fail (and keep re-downloading) the whole document
+                print(f"[PDF] {label} page {i + 1} skipped: {e}")
+                text = ""
+            page = None  # release the page (and its display list) before loading the next
+            out.append((i + 1, " ".join(text.split())))  # same as app.norm
+    # MuPDF keeps decoded fonts/images in a process-wide store that outlives the document;
+    # empty it so a long-lived worker's footprint does not grow with every PDF it has seen
+    fitz.TOOLS.store_shrink(100)
+    return out
@@ -18,8 +18,8 @@ app = App(token=SLACK_BOT_TOKEN)
 # Google Docs API setup
 SCOPES = ["https://www.googleapis.com/auth/documents.readonly", "https://www.googleapis.com/auth/drive"]
 creds = ServiceAccountCredentials.from_json_keyfile_dict(SERVICE_ACCOUNT_JSON, SCOPES)
-docs_service = build("docs", "v1", credentials=creds)
-drive_service = build("drive", "v3", credentials=creds)
+docs_service = build("docs", "v1", credentials=creds, cache_discovery=False)
+drive_service = build("drive", "v3", credentials=creds, cache_discovery=False)
 
 # Gemini setup
 genai.configure(api_key=GEMINI_API_KEY)
@@ -37,18 +37,19 @@ def get_all_docs_content():
     ).execute()
 
     docs = results.get("files", [])
-    context = ""
+    sections = []
     for doc in docs:
         doc_id = doc["id"]
         name = doc["name"]
         doc_data = docs_service.documents().get(documentId=doc_id).execute()
-        text = ""
-        for item in doc_data.get("body", {}).get("content", []):
-            for element in item.get("paragraph", {}).get("elements", []):
-                text += element.get("textRun", {}).get("content", "")
+        text = "".join([
+            element.get("textRun", {}).get("content", "")
+            for item in doc_data.get("body", {}).get("content", [])
+            for element in item.get("paragraph", {}).get("elements", [])
+        ])
         if text.strip():
-            context += f"\n\nFROM {name}:\n{text}"
-    return context or "No document content available."
+            sections.append(f"\n\nFROM {name}:\n{text}")
+    return "".join(sections) or "No document content available."
 
 # Respond to app mentions
 @app.event("app_mention")